@@ -1,4 +1,5 @@
-from .py7z import EXE_PATH, archive_create, archive_extract, archive_test
+from .py7z import (EXE_PATH, SevenZipSession, archive_create, archive_create_async, archive_extract,
+                   archive_extract_parallel, archive_extract_to_stream, archive_test)
 
 if __name__ == '__main__':
     print('Hello World!')
@@ -1,6 +1,12 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import os
+import re
 import subprocess
 import sys
+import tempfile
 
 __author__ = 'Avery'
 
@@ -9,124 +15,617 @@ SYS_BITS = sys.maxsize.bit_length() + 1
 if SYS_BITS not in {32, 64}:
     raise OSError(f'could not determine if system is 32-bit or 64-bit: {SYS_BITS}')
 
-# first try to find the 64-bit executable
-if SYS_BITS == 64:
-    EXE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), f'7-zip/x64/7z.exe'))
-else:
-    EXE_PATH = ''
 
-# fallback to 32-bit
-if not os.path.exists(EXE_PATH):
-    EXE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), f'7-zip/x32/7z.exe'))
+@functools.lru_cache(maxsize=1)
+def _exe_path():
+    """
+    find the bundled 7zip executable, preferring the 64-bit one
+    cached so the filesystem is only checked once per process
+
+    :return: absolute path to 7z.exe
+    """
+    exe_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '7-zip'))
+
+    # first try to find the 64-bit executable
+    if SYS_BITS == 64:
+        exe_path = os.path.join(exe_dir, 'x64', '7z.exe')
+        if os.path.exists(exe_path):
+            return exe_path
+
+    # fallback to 32-bit
+    exe_path = os.path.join(exe_dir, 'x32', '7z.exe')
+    assert os.path.exists(exe_path), 'could not find 7-zip executable'
+    return exe_path
+
+
+EXE_PATH = _exe_path()
+
+# command prefixes, built once
+_BASE_CREATE = (EXE_PATH, 'a')
+_BASE_TEST = (EXE_PATH, 't')
+_BASE_EXTRACT_X = (EXE_PATH, 'x')
+_BASE_EXTRACT_E = (EXE_PATH, 'e')
+_BASE_LIST = (EXE_PATH, 'l', '-slt')
+
+# compression methods and their max level (all except lzma2 need the 7-zip zstd fork instead of the bundled 7-zip)
+_CODEC_MAX_LEVELS = {
+    'lzma2': 9,
+    'zstd': 22,
+    'lz4': 12,
+    'brotli': 11,
+}
+
+# printed by 7zip on success
+_OK_SENTINEL = b'Everything is Ok'
 
-# double-check
-assert os.path.exists(EXE_PATH), 'could not find 7-zip executable'
+# how much of 7zip's output to read at a time, and how much to keep for the return value / error message
+_READ_SIZE = 1 << 15
+_TAIL_SIZE = 1 << 16
 
+# chars that can't be in a windows file or dir name
+_BAD_DIR_CHARS = frozenset('\\/:*?"<>|')
 
-def archive_create(files_and_folders, archive, password=None, encrypt_headers=False, overwrite=False, verbose=3,
-                   volumes=None):
+
+def _log_switches(verbose):
     """
-    create 7z archive from some files and folders
-    files and folders will be placed in the root of the archive
+    switches controlling how much 7zip prints
+    at verbose=0 stdout and progress are silenced entirely so 7zip doesn't spend time formatting a line per file
 
-    :param files_and_folders: list of paths
-    :param archive: path (or name)
-    :param password: ascii only, excluding null bytes and double-quote char
-    :param encrypt_headers: encrypt file names and directory tree within the archive
-    :param overwrite: overwrite existing file (but not dir)
-    :param verbose: loudness as int {0, 1, 2, 3}
-    :param volumes: size of volume, eg '10k' or '2g'
-    :return: output printed by 7zip
+    :param verbose: loudness as int {0, 1, 2, 3}, where 0 silences 7zip's output
+    :return: list of switches
     """
+    assert verbose in {0, 1, 2, 3}, 'verbose must be one of {0, 1, 2, 3}'
 
-    # make paths absolute and unicode
-    archive_path = os.path.abspath(archive)
-    todo_paths = [os.path.abspath(item) for item in files_and_folders]
+    # -bb{N}  -- output log level
+    # -bt     -- show execution time statistics
+    if verbose > 0:
+        return [f'-bb{verbose}', '-bt']
+
+    # -bso0   -- no standard output messages
+    # -bsp0   -- no progress indicator
+    # errors are still written to stderr
+    return ['-bso0', '-bsp0', '-bb0']
+
+
+def _scan_output(tail, chunk, ok, tail_size=_TAIL_SIZE):
+    """
+    append a chunk of 7zip's output to the kept tail (in place), and look for the sentinel
+    the end of the previous chunk is searched too, in case the sentinel was split across reads
+
+    :param tail: bytearray of output so far, trimmed to tail_size
+    :param chunk: bytes-like, just read
+    :param ok: whether the sentinel was already found
+    :return: whether the sentinel has been found
+    """
+    tail += chunk
+    if not ok:
+        ok = tail.find(_OK_SENTINEL, max(0, len(tail) - len(chunk) - len(_OK_SENTINEL) + 1)) != -1
+    del tail[:-tail_size]
+    return ok
+
+
+def _check_output(command, returncode, tail, ok, check_ok):
+    """
+    decode the kept tail of 7zip's output, and fail the same way check_output would
+
+    :param command: list of args
+    :param returncode: 7zip's exit code
+    :param tail: bytearray from _scan_output
+    :param ok: whether the sentinel was found
+    :param check_ok: whether the sentinel was expected
+    :return: last lines printed by 7zip
+    """
+    ret_val = tail.decode('cp1252', errors='replace')
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command, output=ret_val)
+    assert ok or not check_ok, f'something went wrong: {ret_val}'
+    return ret_val
+
+
+def _run(command, check_ok=True, tail_size=_TAIL_SIZE, creationflags=0, input=None, return_output=True):
+    """
+    run 7zip and stream its output through a fixed buffer, keeping only the last few kb in memory
+    the sentinel is searched for as bytes (cp1252 is single-byte, so this is the same as a str search)
+    and only the kept tail is ever decoded
+
+    :param command: list of args
+    :param check_ok: look for 'Everything is Ok' in the output (not printed if stdout is silenced)
+    :param tail_size: how many bytes of output to keep for the return value / error message
+    :param creationflags: windows process creation flags, eg priority class
+    :param input: bytes to send to 7zip's stdin (eg a password, see _password_args)
+    :param return_output: if False, discard 7zip's output unread and rely only on the exit code
+    :return: last lines printed by 7zip, or None if not return_output
+    """
+    # nothing to read, so 7zip can write straight to devnull
+    if not return_output:
+        with subprocess.Popen(command, stdin=None if input is None else subprocess.PIPE, stdout=subprocess.DEVNULL,
+                              close_fds=(os.name != 'nt'), creationflags=creationflags) as p:
+            if input is not None:
+                p.stdin.write(input)
+                p.stdin.close()
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, command)
+        return None
+
+    buffer = bytearray(_READ_SIZE)
+    view = memoryview(buffer)
+    tail = bytearray()
+    ok = False
+
+    # read as it's printed instead of buffering everything with check_output
+    with subprocess.Popen(command, stdin=None if input is None else subprocess.PIPE, stdout=subprocess.PIPE,
+                          bufsize=0, creationflags=creationflags) as p:
+        if input is not None:
+            p.stdin.write(input)
+            p.stdin.close()
+
+        while True:
+            n_bytes = p.stdout.readinto(buffer)
+            if not n_bytes:
+                break
+            ok = _scan_output(tail, view[:n_bytes], ok, tail_size)
+
+    # same behaviour as check_output on failure
+    return _check_output(command, p.returncode, tail, ok, check_ok)
+
+
+def _password_args(password):
+    """
+    how to give 7zip a password
+    7zip's command line parser can't escape a double-quote, so such passwords are typed in at its prompt instead
+
+    :param password: password
+    :return: (password switch, bytes for stdin or None)
+    """
+    assert len(password) > 0, 'password must be at least one character long'
+    if '"' not in password:
+        return f'-p{password}', None
 
-    # check validity of input files and folders
-    seen = dict()
-    for item_path in files_and_folders:
-        seen.setdefault(os.path.basename(item_path), set()).add(item_path)
+    # a bare -p makes 7zip prompt for the password on stdin, supply it twice in case it asks to confirm
+    return '-p', (password + '\n').encode('ascii') * 2
 
-    for item_name, item_paths in seen.items():
-        if len(item_paths) > 1:
+
+def _priority_flags(priority):
+    """
+    process creation flags to run 7zip at some priority (only possible on windows, ignored elsewhere)
+
+    :param priority: 'normal' or 'high'
+    :return: creationflags for subprocess.Popen
+    """
+    assert priority in {'normal', 'high'}, 'priority must be "normal" or "high"'
+    if priority == 'high' and os.name == 'nt':
+        return subprocess.HIGH_PRIORITY_CLASS
+    return 0
+
+
+@functools.lru_cache(maxsize=1)
+def _enable_large_pages():
+    """
+    try to enable SeLockMemoryPrivilege for this process (and hence 7zip, which inherits it), required by -slp
+    only works on windows if the user has "Lock pages in memory" in the local security policy, usually as admin
+    cached since the privilege applies to the whole process
+
+    :return: True if the privilege is now enabled
+    """
+    if os.name != 'nt':
+        return False
+
+    import ctypes
+    from ctypes import wintypes
+
+    class LUID(ctypes.Structure):
+        _fields_ = [('LowPart', wintypes.DWORD),
+                    ('HighPart', wintypes.LONG),
+                    ]
+
+    class TOKEN_PRIVILEGES(ctypes.Structure):
+        _fields_ = [('PrivilegeCount', wintypes.DWORD),
+                    ('Luid', LUID),
+                    ('Attributes', wintypes.DWORD),
+                    ]
+
+    TOKEN_ADJUST_PRIVILEGES = 0x0020
+    TOKEN_QUERY = 0x0008
+    SE_PRIVILEGE_ENABLED = 0x0002
+    ERROR_NOT_ALL_ASSIGNED = 1300
+
+    kernel32 = ctypes.WinDLL('kernel32', use_last_error=True)
+    kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    advapi32 = ctypes.WinDLL('advapi32', use_last_error=True)
+    advapi32.OpenProcessToken.argtypes = [wintypes.HANDLE, wintypes.DWORD, ctypes.POINTER(wintypes.HANDLE)]
+    advapi32.LookupPrivilegeValueW.argtypes = [wintypes.LPCWSTR, wintypes.LPCWSTR, ctypes.POINTER(LUID)]
+    advapi32.AdjustTokenPrivileges.argtypes = [wintypes.HANDLE, wintypes.BOOL, ctypes.POINTER(TOKEN_PRIVILEGES),
+                                               wintypes.DWORD, ctypes.c_void_p, ctypes.c_void_p]
+
+    token = wintypes.HANDLE()
+    if not advapi32.OpenProcessToken(kernel32.GetCurrentProcess(), TOKEN_ADJUST_PRIVILEGES | TOKEN_QUERY,
+                                     ctypes.byref(token)):
+        return False
+    try:
+        privileges = TOKEN_PRIVILEGES(1, LUID(), SE_PRIVILEGE_ENABLED)
+        if not advapi32.LookupPrivilegeValueW(None, 'SeLockMemoryPrivilege', ctypes.byref(privileges.Luid)):
+            return False
+        if not advapi32.AdjustTokenPrivileges(token, False, ctypes.byref(privileges), 0, None, None):
+            return False
+
+        # returns success even if the user doesn't hold the privilege
+        return ctypes.get_last_error() != ERROR_NOT_ALL_ASSIGNED
+    finally:
+        kernel32.CloseHandle(token)
+
+
+def _stream_stdout(command, input, chunk_size):
+    """
+    run 7zip and yield whatever it writes to stdout (eg with -so) in chunks
+
+    :param command: list of args
+    :param input: bytes to send to 7zip's stdin, or None
+    :param chunk_size: max bytes per chunk
+    :return: iterator of bytes
+    """
+    with subprocess.Popen(command, stdin=None if input is None else subprocess.PIPE, stdout=subprocess.PIPE) as p:
+        if input is not None:
+            p.stdin.write(input)
+            p.stdin.close()
+
+        yield from iter(functools.partial(p.stdout.read, chunk_size), b'')
+
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, command)
+
+
+def _abspath(path, cwd):
+    """
+    like os.path.abspath, but with the cwd looked up once by the caller instead of once per path
+
+    :param path: path (absolute or relative to cwd)
+    :param cwd: os.getcwd()
+    :return: absolute normalized path
+    """
+    # drive-relative paths on windows (eg 'D:foo') are relative to that drive's cwd, not ours
+    if os.path.splitdrive(path)[0] and not os.path.isabs(path):
+        return os.path.abspath(path)
+    return os.path.normpath(os.path.join(cwd, path))
+
+
+def _write_list_file(paths):
+    """
+    write paths to a temporary utf-8 list file for 7zip (pass as f'@{list_file_path}' along with -scsUTF-8)
+    windows limits the command line to 32k chars, and non-ascii paths don't survive cp1252
+    the caller must delete the file when done
+
+    :param paths: list of paths
+    :return: path to list file
+    """
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', suffix='.lst', delete=False) as list_file:
+        list_file.write('\n'.join(paths))
+    return list_file.name
+
+
+def _parse_listing(lines):
+    """
+    parse the output of `7z l -slt`
+    the archive's own properties come first, entries start after the '----------' line
+
+    :param lines: iterable of str lines
+    :return: list of dicts, one per entry, eg {'Path': 'a.txt', 'Attributes': 'A_ -rw-r--r--', 'Block': '0', ...}
+    """
+    entries = []
+    entry = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        assert not line.startswith('ERROR'), f'something went wrong: {line}'
+        if entry is None:
+            if line == '----------':
+                entry = dict()
+        elif not line:
+            if entry:
+                entries.append(entry)
+                entry = dict()
+        else:
+            key, sep, value = line.partition(' =')
+            if sep:
+                entry[key] = value[1:]
+    if entry:
+        entries.append(entry)
+
+    return entries
+
+
+def _is_dir(entry):
+    """
+    whether a listed entry is a dir, going by its windows attributes (eg 'D....' vs '....A')
+
+    :param entry: dict from _parse_listing
+    :return: bool
+    """
+    return entry.get('Attributes', '').startswith('D')
+
+
+def _list_entries(archive_path, password):
+    """
+    list the contents of an archive via `7z l -slt`
+
+    :param archive_path: absolute path to archive
+    :param password: password, or an arbitrary one if the archive is not encrypted
+    :return: list of dicts, one per entry (see _parse_listing)
+    """
+    password_switch, password_input = _password_args(password)
+    command = [*_BASE_LIST,
+               archive_path,
+               password_switch,
+               '-sccUTF-8',
+               ]
+
+    with subprocess.Popen(command, stdin=None if password_input is None else subprocess.PIPE, stdout=subprocess.PIPE,
+                          bufsize=1 << 15) as p:
+        if password_input is not None:
+            p.stdin.write(password_input)
+            p.stdin.close()
+
+        entries = _parse_listing(raw.decode('utf-8') for raw in p.stdout)
+
+    if p.returncode:
+        raise subprocess.CalledProcessError(p.returncode, command)
+    return entries
+
+
+def _group_by_block(entries, workers):
+    """
+    split an archive's entries into groups for parallel extraction, without splitting any solid block
+    consecutive blocks go to the same group, entries without a block (empty files / dirs) go in the first group
+    non-empty dirs are left out, since listing one would extract its contents again
+
+    :param entries: list of dicts from _list_entries
+    :param workers: max number of groups
+    :return: list of lists of paths, or None if there's only one block (nothing to parallelize)
+    """
+    parent_dirs = {os.path.dirname(entry['Path']) for entry in entries}
+    blocks = dict()
+    no_block_paths = []
+    for entry in entries:
+        if entry['Path'] in parent_dirs:
+            continue
+        if entry.get('Block'):
+            blocks.setdefault(entry['Block'], []).append(entry['Path'])
+        else:
+            no_block_paths.append(entry['Path'])
+
+    # nothing to parallelize
+    if len(blocks) <= 1 or workers == 1:
+        return None
+
+    # assign consecutive blocks to each group
+    groups = [[] for _ in range(min(workers, len(blocks)))]
+    for block_idx, block_paths in enumerate(blocks.values()):
+        groups[block_idx * len(groups) // len(blocks)].extend(block_paths)
+    groups[0].extend(no_block_paths)
+    return groups
+
+
+def _build_create_cmd(files_and_folders, archive, password=None, encrypt_headers=False, overwrite=False, verbose=0,
+                      volumes=None, threads=None, dict_size='64m', fast_bytes=64, solid=True, large_pages=False,
+                      priority='normal', codec='lzma2', level=9, return_output=True, trust_paths=False):
+    """
+    check the args for archive_create and build the 7zip command, without running anything
+    takes the same params as archive_create, so that it and archive_create_async can just pass on their locals()
+    the input paths are written to a list file, which the caller must delete after running the command
+
+    :return: (command, list file path, bytes for stdin or None, creationflags)
+    """
+
+    # make paths absolute and unicode
+    files_and_folders = [os.fspath(item) for item in files_and_folders]
+    cwd = os.getcwd()
+    archive_path = _abspath(archive, cwd)
+    todo_paths = [_abspath(item, cwd) for item in files_and_folders]
+
+    # check validity of input files and folders (the exact same path twice is fine)
+    item_paths = list(dict.fromkeys(files_and_folders))
+    item_names = [os.path.basename(item_path) for item_path in item_paths]
+    for item_name, count in collections.Counter(item_names).items():
+        if count > 1:
             print(f'multiple items with same filename added to archive: <{item_name}>', file=sys.stderr)
-            for item_path in item_paths:
-                print(f'<{item_path}>', file=sys.stderr)
+            for item_path, other_name in zip(item_paths, item_names):
+                if other_name == item_name:
+                    print(f'<{item_path}>', file=sys.stderr)
             raise ValueError(item_name)
 
-    # 7z will not create an archive over an existing dir
-    assert not os.path.isdir(archive_path), 'dir already exists at output path'
+    if not trust_paths:
+        # 7z will not create an archive over an existing dir
+        assert not os.path.isdir(archive_path), 'dir already exists at output path'
+
+        # don't want to accidentally tell 7zip to overwrite anything
+        assert overwrite or not os.path.isfile(archive_path), 'file already exists at output path'
 
-    # don't want to accidentally tell 7zip to overwrite anything
-    assert overwrite or not os.path.isfile(archive_path), 'file already exists at output path'
+    # use all cores unless told otherwise
+    threads = threads or os.cpu_count() or 1
+    assert threads > 0, 'threads must be a positive int'
+
+    # compression method
+    assert codec in _CODEC_MAX_LEVELS, f'unsupported codec: {codec}'
+    assert 0 <= level <= _CODEC_MAX_LEVELS[codec], f'invalid compression level for {codec}: {level}'
+
+    # compression tuning
+    # note that the dictionary size is stored in the archive and extraction needs about that much ram
+    # (a unit is required, 7zip reads a bare number N as 2^N bytes)
+    assert isinstance(dict_size, str) and re.fullmatch(r'\d+[bkmg]', dict_size), f'invalid dictionary size: {dict_size}'
+    assert 5 <= fast_bytes <= 273, 'fast bytes must be between 5 and 273'
 
     # base command (without input files/folders)
-    command = [EXE_PATH,
-               'a',
+    command = [*_BASE_CREATE,
                archive_path,
                '-t7z',
-               '-m0=lzma2',
-               '-mx=9',
-               f'-bb{verbose}',
-               '-bt',
+               f'-m0={codec}',
+               f'-mx={level}',
+               f'-mmt={threads}',
+               '-mmtf=on',
+               '-ms=on' if solid else '-ms=off',
+               *_log_switches(verbose if return_output else 0),
                ]
 
+    # these only apply to lzma2
+    if codec == 'lzma2':
+        command.extend((f'-md={dict_size}', f'-mfb={fast_bytes}'))
+
     # -t7z         -- type of archive             -> 7z
-    # -m0=lzma2    -- compression algorithm       -> lzma2
-    # -mx=9        -- compression level           -> 9 = ultra
+    # -m0={CODEC}  -- compression algorithm       -> default lzma2
+    # -mx={LEVEL}  -- compression level           -> default 9 = ultra
+    # -mmt={N}     -- number of cpu threads       -> default all cores
+    # -mmtf=on     -- multithreaded filters       -> yes
+    # -md={SIZE}   -- dictionary size             -> default 64Mb
+    # -mfb={N}     -- fast bytes (word size)      -> default 64
+    # -ms=on       -- solid                       -> default yes
     # -aoa         -- duplicate destination files -> oa = overwrite all
-    # -mfb=64      -- fast bytes                  -> what is this
-    # -md=32m      -- dictionary size?            -> 32Mb
-    # -ms=on       -- solid                       -> yes (default)
-    # -d=64m       -- dictionary size             -> 66Mb
     # -mhe         -- encrypt header              -> default off
     # -p{PASSWORD} -- set password = "{PASSWORD}" -> default unencrypted
+    # -slp         -- large memory pages          -> default off
+    # -scsUTF-8    -- charset for list files      -> utf-8
 
     # overwrite
     if overwrite:
-        command += ['-aoa']
+        command.append('-aoa')
 
     # split into volumes (bytes, kilobytes, megabytes, gigabytes)
     # 7z a a.7z *.txt -v10k -v15k -v2m
     # First volume will be 10 KB, second will be 15 KB, and all others will be 2 MB.
     if volumes is not None:
         assert type(volumes) is str and len(volumes) > 0
-        for size in volumes.strip().split():
-            command += [f'-v{size}']
+        command.extend(f'-v{size}' for size in volumes.split())
 
     # add password and header encryption
+    password_input = None
     if password is not None:
-        assert len(password) > 0, 'password must be at least one character long'
+        password_switch, password_input = _password_args(password)
+        command.append(password_switch)
+        if encrypt_headers:
+            command.append('-mhe')
 
-        # need to write and run batch file to use this char
-        if '"' in password:
-            raise NotImplementedError('double-quote not supported')
+    # large pages, if we're allowed to
+    if large_pages and _enable_large_pages():
+        command.append('-slp')
 
-        # command += u' "-p{PASSWORD}"'.format(PASSWORD=password)
-        command += [f'-p{password}']
-        if encrypt_headers:
-            command += ['-mhe']
+    creationflags = _priority_flags(priority)
+
+    # add files via a list file instead of the command line
+    list_file_path = _write_list_file(todo_paths)
+    command.extend(('-scsUTF-8', f'@{list_file_path}'))
+
+    return command, list_file_path, password_input, creationflags
 
-    # add files
-    command += todo_paths
+
+def archive_create(files_and_folders, archive, password=None, encrypt_headers=False, overwrite=False, verbose=0,
+                   volumes=None, threads=None, dict_size='64m', fast_bytes=64, solid=True, large_pages=False,
+                   priority='normal', codec='lzma2', level=9, return_output=True, trust_paths=False):
+    """
+    create 7z archive from some files and folders
+    files and folders will be placed in the root of the archive
+
+    :param files_and_folders: list of paths
+    :param archive: path (or name)
+    :param password: ascii only, excluding null bytes
+    :param encrypt_headers: encrypt file names and directory tree within the archive
+    :param overwrite: overwrite existing file (but not dir)
+    :param verbose: loudness as int {0, 1, 2, 3}, where 0 silences 7zip's output
+    :param volumes: size of volume, eg '10k' or '2g'
+    :param threads: number of compression threads, defaults to the cpu count
+                    (a solid archive only benefits from this with lzma2, not lzma)
+    :param dict_size: lzma2 dictionary size with a unit (b/k/m/g), eg '64m'
+                      (bigger is smaller output but more ram to compress AND extract)
+    :param fast_bytes: lzma2 fast bytes / word size, 5 to 273
+    :param solid: create a solid archive
+    :param large_pages: use large memory pages for the dictionary, fewer tlb misses
+                        (windows only, needs the "Lock pages in memory" privilege, silently skipped without it)
+    :param priority: 'normal' or 'high' process priority for 7zip (windows only)
+    :param codec: 'lzma2' for best ratio, or 'zstd' / 'lz4' / 'brotli' for faster extraction (needs 7-zip zstd)
+    :param level: compression level, 0 to 9 for lzma2 (up to 22 for zstd, 12 for lz4, 11 for brotli)
+    :param return_output: set to False to discard 7zip's output and return None
+    :param trust_paths: skip checking the filesystem at the output path (caller guarantees it's ok)
+    :return: output printed by 7zip (last few lines only)
+    """
+    # must be the first line, so that locals() is exactly the args
+    command, list_file_path, password_input, creationflags = _build_create_cmd(**locals())
 
     # make the file, check that it's okay
-    ret_val = subprocess.check_output(command).decode('cp1252')
-    assert 'Everything is Ok' in ret_val, f'something went wrong: {ret_val}'
+    try:
+        ret_val = _run(command, check_ok=verbose > 0, creationflags=creationflags, input=password_input,
+                       return_output=return_output)
+    finally:
+        os.remove(list_file_path)
 
     # TODO: parse ret_val into something useful
     return ret_val
 
 
-def archive_test(archive, password=None, verbose=3):
+async def archive_create_async(files_and_folders, archive, password=None, encrypt_headers=False, overwrite=False,
+                               verbose=0, volumes=None, threads=None, dict_size='64m', fast_bytes=64, solid=True,
+                               large_pages=False, priority='normal', codec='lzma2', level=9, return_output=True,
+                               trust_paths=False):
+    """
+    same as archive_create (see there for the params), but as a coroutine so many archives can be created at once
+    each 7zip already uses several threads, so limit how many run together, eg with a semaphore:
+
+    semaphore = asyncio.Semaphore(os.cpu_count() // 4)
+    async def create(files, archive):
+        async with semaphore:
+            return await archive_create_async(files, archive, threads=4)
+    await asyncio.gather(*(create(files, archive) for files, archive in jobs))
+
+    :return: output printed by 7zip (last few lines only), or None if not return_output
+    """
+    # must be the first line, so that locals() is exactly the args
+    command, list_file_path, password_input, creationflags = _build_create_cmd(**locals())
+
+    # make the file, keeping only the tail of the output like _run does
+    tail = bytearray()
+    ok = False
+    try:
+        p = await asyncio.create_subprocess_exec(*command,
+                                                 stdin=None if password_input is None else subprocess.PIPE,
+                                                 stdout=subprocess.PIPE if return_output else subprocess.DEVNULL,
+                                                 creationflags=creationflags)
+        try:
+            if password_input is not None:
+                p.stdin.write(password_input)
+                await p.stdin.drain()
+                p.stdin.close()
+
+            while return_output:
+                chunk = await p.stdout.read(_READ_SIZE)
+                if not chunk:
+                    break
+                ok = _scan_output(tail, chunk, ok)
+            await p.wait()
+
+        # eg cancelled, don't leave 7zip writing a half-built archive
+        except BaseException:
+            if p.returncode is None:
+                p.kill()
+                await p.wait()
+            raise
+    finally:
+        os.remove(list_file_path)
+
+    # check that it's okay
+    if not return_output:
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, command)
+        return None
+    return _check_output(command, p.returncode, tail, ok, check_ok=verbose > 0)
+
+
+def archive_test(archive, password=None, verbose=0, quick=False, return_output=True):
     """
     test the integrity of an archive
 
     :param archive: path (or name)
-    :param password: ascii only, excluding null bytes and double-quote char
-    :param verbose: loudness as int {0, 1, 2, 3}
-    :return: output printed by 7zip
+    :param password: ascii only, excluding null bytes
+    :param verbose: loudness as int {0, 1, 2, 3}, where 0 silences 7zip's output
+    :param quick: only check that the headers can be read and list a crc for every file, without decompressing
+                  (much faster, but won't catch corrupted file data, nor a wrong password unless headers are encrypted)
+    :param return_output: set to False to discard 7zip's output and return None (ignored if quick)
+    :return: output printed by 7zip (last few lines only), or list of entries (dicts) if quick
     """
     archive_path = os.path.abspath(archive)
 
@@ -134,51 +633,58 @@ def archive_test(archive, password=None, verbose=3):
     if password is None:
         password = '\x7f'  # ascii for DEL key
 
-    # validity of provided password (if any)
-    assert len(password) > 0, 'password must be at least one character long'
-
-    # need to write and run batch file to use this char
-    if '"' in password:
-        raise NotImplementedError('double-quote not supported')
+    # only read the headers
+    if quick:
+        entries = _list_entries(archive_path, password)
+        for entry in entries:
+            if not _is_dir(entry) and entry.get('Size') != '0':
+                assert entry.get('CRC'), f'missing crc: {entry}'
+        return entries
 
     # always supply a password
-    command = [EXE_PATH,
-               't',
+    password_switch, password_input = _password_args(password)
+    command = [*_BASE_TEST,
                archive_path,
-               f'-p{password}',
-               f'-bb{verbose}',
-               '-bt',
+               password_switch,
+               *_log_switches(verbose),
                ]
 
     # make the file, check that it's okay
-    ret_val = subprocess.check_output(command).decode('cp1252')
-    assert 'Everything is Ok' in ret_val, f'something went wrong: {ret_val}'
+    ret_val = _run(command, check_ok=verbose > 0, input=password_input, return_output=return_output)
 
     # TODO: parse ret_val into something useful
     return ret_val
 
 
-def archive_extract(archive, into_dir=None, password=None, flat=False, overwrite=True, verbose=3):
+def archive_extract(archive, into_dir=None, password=None, flat=False, overwrite=True, verbose=0, threads=None,
+                    members=None, return_output=True, trust_paths=False):
     """
     extract an archive
     if a split-volumes archive, specify the first file (example.7z.001)
+    ram needed scales with the dictionary size the archive was compressed with
     :param archive: path to archive
     :param into_dir: where to extract to
-    :param password: ascii only, excluding null bytes and double-quote char
+    :param password: ascii only, excluding null bytes
     :param flat: extract all files into target dir ignoring directory structure
     :param overwrite: True or False or advanced options
-    :param verbose: loudness as int {0, 1, 2, 3}
-    :return: output printed by 7zip
+    :param verbose: loudness as int {0, 1, 2, 3}, where 0 silences 7zip's output
+    :param threads: max decompression threads, defaults to the cpu count
+                    (only helps codecs that decode with multiple threads, eg bzip2;
+                    lzma2 decoding is single-threaded in the bundled 7-zip 16.02)
+    :param members: only extract these paths within the archive (default all)
+    :param return_output: set to False to discard 7zip's output and return None
+    :param trust_paths: skip checking the filesystem at the archive and output dir (caller guarantees they're ok)
+    :return: output printed by 7zip (last few lines only)
     """
     archive_path = os.path.abspath(archive)
-    assert os.path.isfile(archive_path), 'archive does not exist at provided path'
+    assert trust_paths or os.path.isfile(archive_path), 'archive does not exist at provided path'
 
     # set arbitrary password if none given
     if password is None:
         password = '\x7f'  # ascii for DEL key
 
     # validity of provided password (if any)
-    assert len(password) > 0, 'password must be at least one character long'
+    password_switch, password_input = _password_args(password)
 
     # set arbitrary password if none given
     if into_dir is None:
@@ -187,12 +693,8 @@ def archive_extract(archive, into_dir=None, password=None, flat=False, overwrite
     # validity of provided dirname (if any)
     into_dir = os.path.abspath(into_dir.strip())
     assert len(into_dir) > 0, 'output dir name must be at least one character long'
-    assert all(char not in os.path.basename(into_dir) for char in '\\/:*?"<>|'), 'invalid dir name'
-    assert not os.path.isfile(into_dir), 'file exists at output dir location, cannot create folder'
-
-    # need to write and run batch file to use this char
-    if '"' in password:
-        raise NotImplementedError('double-quote not supported')
+    assert _BAD_DIR_CHARS.isdisjoint(os.path.basename(into_dir)), 'invalid dir name'
+    assert trust_paths or not os.path.isfile(into_dir), 'file exists at output dir location, cannot create folder'
 
     if overwrite is True:
         overwrite = 'a'
@@ -205,34 +707,200 @@ def archive_extract(archive, into_dir=None, password=None, flat=False, overwrite
         't',  # auto rename existing file
     }
 
+    # allow all cores unless told otherwise (only used by codecs with multithreaded decoding)
+    threads = threads or os.cpu_count() or 1
+    assert threads > 0, 'threads must be a positive int'
+
     # make command
-    command = [EXE_PATH,
-               'e' if flat else 'x',  # decide which flag to use
+    command = [*(_BASE_EXTRACT_E if flat else _BASE_EXTRACT_X),  # decide which flag to use
                f'-o{into_dir}',
-               f'-p{password}',
+               password_switch,
                f'-ao{overwrite}',
-               f'-bb{verbose}',
-               '-bt',
-               archive_path,  # must be last argument for extraction
+               f'-mmt={threads}',
+               *_log_switches(verbose),
+               archive_path,  # must be last argument for extraction (except list files)
                ]
 
-    # make the file, check that it's okay
-    ret_val = subprocess.check_output(command).decode('cp1252')
-    assert 'Everything is Ok' in ret_val, f'something went wrong: {ret_val}'
+    # extract everything
+    if members is None:
+        ret_val = _run(command, check_ok=verbose > 0, input=password_input, return_output=return_output)
+
+    # only extract the listed members, matched exactly (no wildcards)
+    else:
+        list_file_path = _write_list_file(members)
+        command[-1:-1] = ['-scsUTF-8', '-spd']
+        command.append(f'@{list_file_path}')
+        try:
+            ret_val = _run(command, check_ok=verbose > 0, input=password_input, return_output=return_output)
+        finally:
+            os.remove(list_file_path)
 
     # TODO: parse ret_val into something useful
     return ret_val
 
 
+def archive_extract_to_stream(archive, member, password=None, chunk_size=1 << 20, trust_paths=False):
+    """
+    extract a single file from an archive without writing it to disk
+    yields the file's bytes as 7zip decompresses them, so they can go straight into a hash / parser / upload
+
+    :param archive: path to archive
+    :param member: path of the file within the archive
+    :param password: ascii only, excluding null bytes
+    :param chunk_size: max bytes per chunk
+    :param trust_paths: skip checking that the archive exists (caller guarantees it does)
+    :return: iterator of bytes
+    :raises KeyError: if the archive has no such file
+    """
+    archive_path = os.path.abspath(archive)
+    assert trust_paths or os.path.isfile(archive_path), 'archive does not exist at provided path'
+
+    # set arbitrary password if none given
+    if password is None:
+        password = '\x7f'  # ascii for DEL key
+    password_switch, password_input = _password_args(password)
+
+    # 7zip exits 0 with no output for a missing member, which would look like an empty file
+    member_path = os.path.normpath(member)
+    if not any(os.path.normpath(entry['Path']) == member_path and not _is_dir(entry)
+               for entry in _list_entries(archive_path, password)):
+        raise KeyError(member)
+
+    # -so writes the file data to stdout, so silence the messages and progress
+    command = [*_BASE_EXTRACT_X,
+               '-so',
+               password_switch,
+               '-bso0',
+               '-bsp0',
+               '-spd',  # member is an exact path, not a wildcard
+               '--',  # stop parsing switches, in case the member starts with '-'
+               archive_path,
+               member,
+               ]
+
+    # args are checked above when called, 7zip only starts once the caller begins reading
+    return _stream_stdout(command, password_input, chunk_size)
+
+
+def archive_extract_parallel(archive, into_dir=None, password=None, overwrite=True, verbose=0, workers=None,
+                             threads=None, selector_groups=None, return_output=True, trust_paths=False):
+    """
+    extract an archive using several 7zip processes at once, each handling a disjoint subset of the files
+    only helps if the archive has more than one solid block (eg non-solid, or multithreaded lzma2 with a big input),
+    so files are grouped by block to avoid two processes decompressing the same block
+    falls back to a single archive_extract if there is only one block
+
+    :param archive: path to archive
+    :param into_dir: where to extract to
+    :param password: ascii only, excluding null bytes
+    :param overwrite: True or False or advanced options
+    :param verbose: loudness as int {0, 1, 2, 3}, where 0 silences 7zip's output
+    :param workers: max number of 7zip processes, defaults to the cpu count
+    :param threads: max decompression threads per process, defaults to the cpu count divided by workers
+                    (only helps codecs that decode with multiple threads, see archive_extract)
+    :param selector_groups: list of lists of paths within the archive, one process per list (default group by block)
+    :param return_output: set to False to discard 7zip's output (each process returns None)
+    :param trust_paths: skip checking the filesystem at the archive and output dir (caller guarantees they're ok)
+    :return: list of outputs printed by 7zip (last few lines only), one per process
+    """
+    workers = workers or os.cpu_count() or 1
+    assert workers > 0, 'workers must be a positive int'
+    threads = threads or max(1, (os.cpu_count() or 1) // workers)
+    kwargs = dict(into_dir=into_dir, password=password, overwrite=overwrite, verbose=verbose, threads=threads,
+                  return_output=return_output, trust_paths=trust_paths)
+
+    # group the files by block, dirs are created by 7zip along with their contents
+    if selector_groups is None:
+        entries = _list_entries(os.path.abspath(archive), '\x7f' if password is None else password)
+        selector_groups = _group_by_block(entries, workers)
+
+        # nothing to parallelize
+        if selector_groups is None:
+            return [archive_extract(archive, **kwargs)]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        jobs = [executor.submit(archive_extract, archive, members=group, **kwargs) for group in selector_groups]
+        ret_vals = [job.result() for job in jobs]
+
+    return ret_vals
+
+
+class SevenZipSession:
+    """
+    run many 7zip jobs through a fixed pool of workers
+    7zip has no interactive mode that could be kept alive between jobs, so each job is still its own 7z.exe,
+    but at most `workers` of them run at once and the rest wait in a queue instead of all spawning together
+    each method takes the same args as the matching function and returns a concurrent.futures.Future
+
+    with SevenZipSession(workers=4) as session:
+        jobs = [session.extract(path, into_dir=path + '_out', threads=1) for path in archive_paths]
+        results = [job.result() for job in jobs]
+    """
+
+    def __init__(self, workers=None):
+        """
+        :param workers: max number of 7zip processes to run at the same time, defaults to the cpu count
+                        (consider passing threads=cpu_count/workers to each job to avoid oversubscribing)
+        """
+        self.workers = workers or os.cpu_count() or 1
+        assert self.workers > 0, 'workers must be a positive int'
+
+        # threads are enough since the actual work happens in the 7zip child processes
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self, wait=True):
+        """
+        stop accepting jobs
+        :param wait: block until queued jobs are done
+        """
+        self._executor.shutdown(wait=wait)
+
+    def create(self, *args, **kwargs):
+        """
+        queue archive_create(*args, **kwargs)
+        :return: Future of its return value
+        """
+        return self._executor.submit(archive_create, *args, **kwargs)
+
+    def test(self, *args, **kwargs):
+        """
+        queue archive_test(*args, **kwargs)
+        :return: Future of its return value
+        """
+        return self._executor.submit(archive_test, *args, **kwargs)
+
+    def extract(self, *args, **kwargs):
+        """
+        queue archive_extract(*args, **kwargs)
+        :return: Future of its return value
+        """
+        return self._executor.submit(archive_extract, *args, **kwargs)
+
+
 if __name__ == '__main__':
     import fnmatch
     import shutil
 
 
     def crawl(top, file_pattern='*'):
-        for path, dir_list, file_list in os.walk(top):
-            for file_name in fnmatch.filter(file_list, file_pattern):
-                yield os.path.join(path, file_name)
+        # scandir avoids os.walk's extra stat per entry, and the pattern is compiled only once
+        # (case-insensitive on windows, like fnmatch.filter)
+        match = re.compile(fnmatch.translate(file_pattern), re.IGNORECASE if os.name == 'nt' else 0).match
+        todo_dirs = [top]
+        while todo_dirs:
+            with os.scandir(todo_dirs.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        if not entry.is_symlink():
+                            todo_dirs.append(entry.path)
+                    elif match(entry.name):
+                        yield entry.path
 
 
     # cleanup existing 7z
@@ -0,0 +1,110 @@
+import os
+import unittest
+
+from py7z.py7z import _build_create_cmd, _group_by_block, _is_dir, _parse_listing
+
+# `7z l -slt` from 7-zip 16.02 for a solid archive with two blocks, a dir, an empty dir and an empty file
+LISTING = f'''
+7-Zip [64] 16.02 : Copyright (c) 1999-2016 Igor Pavlov : 2016-05-21
+
+Scanning the drive for archives:
+1 file, 1093 bytes (2 KiB)
+
+Listing archive: test.7z
+
+--
+Path = test.7z
+Type = 7z
+Physical Size = 1093
+Headers Size = 311
+Method = LZMA2:24
+Solid = +
+Blocks = 2
+
+----------
+Path = d
+Size = 0
+Packed Size = 0
+Modified = 2020-01-02 03:04:05
+Attributes = D....
+CRC = 
+Encrypted = -
+Method = 
+Block = 
+
+Path = e
+Size = 0
+Packed Size = 0
+Modified = 2020-01-02 03:04:05
+Attributes = D....
+CRC = 
+Encrypted = -
+Method = 
+Block = 
+
+Path = {os.path.join('d', 'a.txt')}
+Size = 400
+Packed Size = 391
+Modified = 2020-01-02 03:04:05
+Attributes = ....A
+CRC = 1D2F8B4C
+Encrypted = -
+Method = LZMA2:24
+Block = 0
+
+Path = b.txt
+Size = 391
+Packed Size = 391
+Modified = 2020-01-02 03:04:05
+Attributes = ....A
+CRC = 90C1D6E2
+Encrypted = -
+Method = LZMA2:24
+Block = 1
+
+Path = empty.txt
+Size = 0
+Packed Size = 0
+Modified = 2020-01-02 03:04:05
+Attributes = ....A
+CRC = 
+Encrypted = -
+Method = 
+Block = 
+
+'''
+
+
+class TestListing(unittest.TestCase):
+    def test_parse_listing(self):
+        entries = _parse_listing(LISTING.splitlines())
+        self.assertEqual([entry['Path'] for entry in entries],
+                         ['d', 'e', os.path.join('d', 'a.txt'), 'b.txt', 'empty.txt'])
+        self.assertEqual(entries[0]['Attributes'], 'D....')
+        self.assertEqual(entries[0]['Block'], '')
+        self.assertEqual(entries[3]['CRC'], '90C1D6E2')
+
+    def test_is_dir(self):
+        entries = _parse_listing(LISTING.splitlines())
+        self.assertEqual([entry['Path'] for entry in entries if _is_dir(entry)], ['d', 'e'])
+
+    def test_group_by_block(self):
+        entries = _parse_listing(LISTING.splitlines())
+        self.assertEqual(_group_by_block(entries, workers=4),
+                         [[os.path.join('d', 'a.txt'), 'e', 'empty.txt'], ['b.txt']])
+
+    def test_group_by_block_single_block(self):
+        entries = [entry for entry in _parse_listing(LISTING.splitlines()) if entry['Path'] != 'b.txt']
+        self.assertIsNone(_group_by_block(entries, workers=4))
+        self.assertIsNone(_group_by_block(_parse_listing(LISTING.splitlines()), workers=1))
+
+
+class TestCreateArgs(unittest.TestCase):
+    def test_dict_size_needs_unit(self):
+        for dict_size in [64, '26', '64M', 'm']:
+            with self.assertRaises(AssertionError):
+                _build_create_cmd(['a.txt'], 'test.7z', dict_size=dict_size, trust_paths=True)
+
+
+if __name__ == '__main__':
+    unittest.main()